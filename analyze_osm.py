@@ -4,7 +4,84 @@ from collections import Counter
 import datetime
 from tqdm import tqdm
 import os
+import json
+import platform
+import shutil
+import subprocess
+from osm_tags import NODE_TAG_KEYS, WAY_TAG_KEYS, RELATION_TAG_KEYS
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Buffer nodes for bulk reduction with NumPy/Numba. Under PyPy the JIT already compiles
+# the per-node comparisons, and NumPy access through cpyext would only slow them down.
+BUFFER_NODES = np is not None and platform.python_implementation() != 'PyPy'
+
+# Number of nodes buffered before they are reduced into the bounds and stop counts
+NODE_BUFFER_SIZE = 1 << 16
+
+# Bit flags recorded for each buffered node. A node can be several of these at once
+# (e.g. a bus stop mapped as a stop position), so they are combined rather than enumerated.
+HAS_LOCATION = 1
+BUS_STOP = 2
+SUBWAY_STATION = 4
+STOP_POSITION = 8
+
+njit = None
+if BUFFER_NODES:
+    try:
+        from numba import njit, prange
+    except ImportError:
+        pass
+
+# Compiled handler from analyze_osm_core.pyx, used instead of OSMStatsHandler when built
+try:
+    from analyze_osm_core import OSMStatsHandlerC
+except ImportError:
+    OSMStatsHandlerC = None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _reduce_nodes(lat, lon, flags, min_lat, max_lat, min_lon, max_lon):
+        """Fold a buffer of nodes into the running bounds and count the flagged stop types."""
+        bus_stops = 0
+        subway_stations = 0
+        stop_positions = 0
+        for i in prange(flags.shape[0]):
+            f = flags[i]
+            if f & HAS_LOCATION:
+                min_lat = min(min_lat, lat[i])
+                max_lat = max(max_lat, lat[i])
+                min_lon = min(min_lon, lon[i])
+                max_lon = max(max_lon, lon[i])
+            if f & BUS_STOP:
+                bus_stops += 1
+            if f & SUBWAY_STATION:
+                subway_stations += 1
+            if f & STOP_POSITION:
+                stop_positions += 1
+        return min_lat, max_lat, min_lon, max_lon, bus_stops, subway_stations, stop_positions
+else:
+    def _reduce_nodes(lat, lon, flags, min_lat, max_lat, min_lon, max_lon):
+        """Fold a buffer of nodes into the running bounds and count the flagged stop types."""
+        # Nearly every buffered node has a location, so only copy out a subset when needed
+        located = (flags & HAS_LOCATION) != 0
+        if not located.all():
+            lat = lat[located]
+            lon = lon[located]
+        if lat.size:
+            min_lat = min(min_lat, float(lat.min()))
+            max_lat = max(max_lat, float(lat.max()))
+            min_lon = min(min_lon, float(lon.min()))
+            max_lon = max(max_lon, float(lon.max()))
+        return (min_lat, max_lat, min_lon, max_lon,
+                int(np.count_nonzero(flags & BUS_STOP)),
+                int(np.count_nonzero(flags & SUBWAY_STATION)),
+                int(np.count_nonzero(flags & STOP_POSITION)))
+
+# The tag scans in node/way/relation are mirrored in analyze_osm_core.pyx; keep them in sync
 class OSMStatsHandler(osmium.SimpleHandler):
     def __init__(self):
         super(OSMStatsHandler, self).__init__()
@@ -25,6 +102,19 @@ class OSMStatsHandler(osmium.SimpleHandler):
         self.min_lon = 180.0
         self.max_lon = -180.0
         
+        # Nodes waiting to be reduced by _reduce_nodes, stored as parallel arrays
+        if BUFFER_NODES:
+            self._lat_buf = np.empty(NODE_BUFFER_SIZE, dtype=np.float64)
+            self._lon_buf = np.empty(NODE_BUFFER_SIZE, dtype=np.float64)
+            self._flag_buf = np.empty(NODE_BUFFER_SIZE, dtype=np.int32)
+        self._buf_len = 0
+        
+        # Tag values waiting to be counted; Counter.update runs the tally loop in C
+        self._public_transport_buf = []
+        self._highway_buf = []
+        self._railway_buf = []
+        self._route_buf = []
+        
         # For progress tracking
         self.progress = None
         self.current_element = 0
@@ -34,64 +124,178 @@ class OSMStatsHandler(osmium.SimpleHandler):
         self.num_nodes += 1
         self._update_progress()
         
-        # Update geographic bounds
-        if n.location.valid():
-            lat = n.location.lat
-            lon = n.location.lon
-            self.min_lat = min(self.min_lat, lat)
-            self.max_lat = max(self.max_lat, lat)
-            self.min_lon = min(self.min_lon, lon)
-            self.max_lon = max(self.max_lon, lon)
+        # Most nodes are untagged way geometry; for the rest, pick out the keys of
+        # interest in a single pass over the TagList instead of copying it into a dict
+        flags = 0
+        tags = n.tags
+        if tags:
+            got = {}
+            for tag in tags:
+                k = tag.k
+                if k in NODE_TAG_KEYS:
+                    got[k] = tag.v
+            public_transport = got.get('public_transport')
+            highway = got.get('highway')
+            railway = got.get('railway')
+            subway = got.get('subway')
+            network = got.get('network')
+            
+            # Count transport-related nodes; fixed stop types are flagged for _reduce_nodes
+            if public_transport is not None:
+                self._public_transport_buf.append(public_transport)
+                if public_transport == 'stop_position':
+                    flags |= STOP_POSITION
+            
+            if highway == 'bus_stop':
+                flags |= BUS_STOP
+                
+            if railway == 'station':
+                if subway == 'yes' or (network is not None and 'subway' in network.lower()):
+                    flags |= SUBWAY_STATION
         
-        # Count transport-related nodes
-        tags = {tag.k: tag.v for tag in n.tags}
-        if 'public_transport' in tags:
-            self.public_transport[tags['public_transport']] += 1
-            if tags.get('public_transport') == 'stop_position':
-                self.transit_stops += 1
+        location = n.location
+        if location.valid():
+            flags |= HAS_LOCATION
         
-        if tags.get('highway') == 'bus_stop':
-            self.bus_stops += 1
-            
-        if tags.get('railway') == 'station':
-            if tags.get('subway') == 'yes' or 'subway' in tags.get('network', '').lower():
+        # Nodes with neither a location nor a stop flag contribute nothing to the buffer
+        if not flags:
+            return
+        
+        if not BUFFER_NODES:
+            # Apply the node directly; plain comparisons are what PyPy's JIT handles best
+            if flags & HAS_LOCATION:
+                lat = location.lat
+                lon = location.lon
+                if lat < self.min_lat:
+                    self.min_lat = lat
+                if lat > self.max_lat:
+                    self.max_lat = lat
+                if lon < self.min_lon:
+                    self.min_lon = lon
+                if lon > self.max_lon:
+                    self.max_lon = lon
+            if flags & BUS_STOP:
+                self.bus_stops += 1
+            if flags & SUBWAY_STATION:
                 self.subway_stations += 1
+            if flags & STOP_POSITION:
+                self.transit_stops += 1
+            return
+        
+        i = self._buf_len
+        if flags & HAS_LOCATION:
+            self._lat_buf[i] = location.lat
+            self._lon_buf[i] = location.lon
+        self._flag_buf[i] = flags
+        self._buf_len = i + 1
+        if self._buf_len == NODE_BUFFER_SIZE:
+            self._flush_nodes()
 
     def way(self, w):
         self.num_ways += 1
         self._update_progress()
         
-        tags = {tag.k: tag.v for tag in w.tags}
+        tags = w.tags
+        if not tags:
+            return
         
-        if 'highway' in tags:
-            self.highway_types[tags['highway']] += 1
-            
-        if 'railway' in tags:
-            self.railway_types[tags['railway']] += 1
+        got = {}
+        for tag in tags:
+            k = tag.k
+            if k in WAY_TAG_KEYS:
+                got[k] = tag.v
+        if not got:
+            return
+        
+        if 'highway' in got:
+            self._highway_buf.append(got['highway'])
+        if 'railway' in got:
+            self._railway_buf.append(got['railway'])
 
     def relation(self, r):
         self.num_relations += 1
         self._update_progress()
         
-        tags = {tag.k: tag.v for tag in r.tags}
+        tags = r.tags
+        if not tags:
+            return
         
-        if tags.get('type') == 'route':
-            if 'route' in tags:
-                self.transit_routes[tags['route']] += 1
+        got = {}
+        for tag in tags:
+            k = tag.k
+            if k in RELATION_TAG_KEYS:
+                got[k] = tag.v
+        
+        if got.get('type') == 'route':
+            route = got.get('route')
+            if route is not None:
+                self._route_buf.append(route)
+    
+    def _flush_nodes(self):
+        """Reduce the buffered nodes into the geographic bounds and stop counts."""
+        count = self._buf_len
+        if count == 0:
+            return
+        (self.min_lat, self.max_lat, self.min_lon, self.max_lon,
+         bus_stops, subway_stations, stop_positions) = _reduce_nodes(
+            self._lat_buf[:count], self._lon_buf[:count], self._flag_buf[:count],
+            self.min_lat, self.max_lat, self.min_lon, self.max_lon)
+        self.bus_stops += bus_stops
+        self.subway_stations += subway_stations
+        self.transit_stops += stop_positions
+        self._buf_len = 0
+    
+    def _flush_tags(self):
+        """Count the buffered tag values into their Counters."""
+        for counter, buf in ((self.public_transport, self._public_transport_buf),
+                             (self.highway_types, self._highway_buf),
+                             (self.railway_types, self._railway_buf),
+                             (self.transit_routes, self._route_buf)):
+            if buf:
+                counter.update(buf)
+                buf.clear()
+    
+    def flush(self):
+        """Process any buffered data. Call once after the file has been applied."""
+        self._flush_nodes()
+        self._flush_tags()
     
     def _update_progress(self):
-        """Update the progress bar."""
-        if self.progress is not None:
-            self.current_element += 1
-            if self.current_element % 10000 == 0:  # Update every 10000 elements to avoid slowdown
+        """Update the progress bar and count buffered tag values."""
+        self.current_element += 1
+        if self.current_element % 10000 == 0:  # Update every 10000 elements to avoid slowdown
+            self._flush_tags()
+            if self.progress is not None:
                 self.progress.update(10000)
-                self.progress.set_description(f"Nodes: {self.num_nodes:,} | Ways: {self.num_ways:,} | Relations: {self.num_relations:,}")
+                # Rebuilding the description is far costlier than advancing the bar
+                if self.current_element % 1000000 == 0:
+                    self.progress.set_description("Nodes: %d | Ways: %d | Relations: %d"
+                                                  % (self.num_nodes, self.num_ways, self.num_relations))
     
     def set_progress_bar(self, total_estimate):
         """Initialize the progress bar with estimated total elements."""
         self.total_elements = total_estimate
-        self.progress = tqdm(total=total_estimate, unit='elements')
+        self.progress = tqdm(total=total_estimate, unit='elements', mininterval=0.5)
         self.progress.set_description("Processing OSM data")
+    
+    def close_progress(self):
+        """Account for elements since the last bar update and close the progress bar."""
+        if self.progress is not None:
+            self.progress.update(self.current_element % 10000)
+            self.progress.close()
+
+def count_elements(pbf_file):
+    """Count the elements in the file with osmium-tool. Returns None if it is unavailable."""
+    if shutil.which('osmium') is None:
+        return None
+    try:
+        result = subprocess.run(['osmium', 'fileinfo', '--extended', '--json', pbf_file],
+                                capture_output=True, text=True, check=True)
+        counts = json.loads(result.stdout)['data']['count']
+        return counts['nodes'] + counts['ways'] + counts['relations']
+    except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+        print(f"Could not count elements with osmium-tool: {e}")
+        return None
 
 def estimate_elements(pbf_file):
     """Estimate the number of elements in the file based on file size."""
@@ -100,27 +304,48 @@ def estimate_elements(pbf_file):
     estimated_elements = int(file_size / 50000000 * 1000000)
     return max(estimated_elements, 1000000)  # At least 1 million to be safe
 
+def apply_file(handler, pbf_file):
+    """Run the handler over the file, decoding PBF blocks on libosmium's thread pool."""
+    # libosmium decompresses PBF blocks on a shared pool that is sized from this variable
+    # when first used; default to every core so decoding stays ahead of the callbacks
+    os.environ.setdefault('OSMIUM_POOL_THREADS', str(os.cpu_count() or 1))
+    
+    # Changesets are never used, so let the reader skip them
+    entity_bits = osmium.osm.osm_entity_bits
+    reader = osmium.io.Reader(pbf_file, entity_bits.NODE | entity_bits.WAY | entity_bits.RELATION)
+    try:
+        osmium.apply(reader, handler)
+    finally:
+        reader.close()
+
 def main(pbf_file):
     print(f"Starting analysis of {pbf_file}...")
     print(f"Time started: {datetime.datetime.now()}")
     
-    # Create handler
-    handler = OSMStatsHandler()
+    # Create handler, preferring the compiled one
+    if OSMStatsHandlerC is not None:
+        print("Using compiled handler (analyze_osm_core)")
+        handler = OSMStatsHandlerC()
+    else:
+        handler = OSMStatsHandler()
     
-    # Estimate total elements for progress bar
-    total_estimate = estimate_elements(pbf_file)
-    print(f"Estimated elements to process: ~{total_estimate:,}")
-    handler.set_progress_bar(total_estimate)
+    # Count total elements for progress bar, falling back to a file-size estimate
+    total_elements = count_elements(pbf_file)
+    if total_elements is not None:
+        print(f"Elements to process: {total_elements:,}")
+    else:
+        total_elements = estimate_elements(pbf_file)
+        print(f"Estimated elements to process: ~{total_elements:,}")
+    handler.set_progress_bar(total_elements)
     
     # Process the file
     try:
-        handler.apply_file(pbf_file)
-        if handler.progress:
-            handler.progress.close()
+        apply_file(handler, pbf_file)
+        handler.flush()
+        handler.close_progress()
     except Exception as e:
         print(f"Error processing file: {e}")
-        if handler.progress:
-            handler.progress.close()
+        handler.close_progress()
         return
     
     # Basic stats
@@ -0,0 +1,198 @@
+# cython: language_level=3
+"""Compiled counterpart of analyze_osm.OSMStatsHandler.
+
+Build in place with ``python setup.py build_ext --inplace``; analyze_osm.py picks up
+OSMStatsHandlerC automatically when the extension is importable.
+"""
+import osmium
+from collections import Counter
+from tqdm import tqdm
+from osm_tags import NODE_TAG_KEYS, WAY_TAG_KEYS, RELATION_TAG_KEYS
+
+
+cdef class _Stats:
+    """Per-element counters and bounds, kept as C fields so updates skip the interpreter."""
+    cdef public long long num_nodes, num_ways, num_relations
+    cdef public long long transit_stops, subway_stations, bus_stops
+    cdef public long long current_element
+    cdef public double min_lat, max_lat, min_lon, max_lon
+
+    def __cinit__(self):
+        self.min_lat = 90.0
+        self.max_lat = -90.0
+        self.min_lon = 180.0
+        self.max_lon = -180.0
+
+
+# The tag scans in node/way/relation mirror analyze_osm.OSMStatsHandler; keep them in sync
+class OSMStatsHandlerC(osmium.SimpleHandler):
+    def __init__(self):
+        super(OSMStatsHandlerC, self).__init__()
+        self._stats = _Stats()
+        self.highway_types = Counter()
+        self.railway_types = Counter()
+        self.public_transport = Counter()
+        self.transit_routes = Counter()
+
+        # Tag values waiting to be counted; Counter.update runs the tally loop in C
+        self._public_transport_buf = []
+        self._highway_buf = []
+        self._railway_buf = []
+        self._route_buf = []
+
+        # For progress tracking
+        self.progress = None
+        self.total_elements = 0
+        self._publish_stats()
+
+    def node(self, n):
+        cdef _Stats st = self._stats
+        cdef double lat, lon
+        st.num_nodes += 1
+        st.current_element += 1
+        if st.current_element % 10000 == 0:
+            self._update_progress()
+
+        # Bounds are cheap C comparisons here, so no location buffering is needed
+        location = n.location
+        if location.valid():
+            lat = location.lat
+            lon = location.lon
+            if lat < st.min_lat:
+                st.min_lat = lat
+            if lat > st.max_lat:
+                st.max_lat = lat
+            if lon < st.min_lon:
+                st.min_lon = lon
+            if lon > st.max_lon:
+                st.max_lon = lon
+
+        # Most nodes are untagged way geometry; for the rest, pick out the keys of
+        # interest in a single pass over the TagList
+        tags = n.tags
+        if not tags:
+            return
+
+        got = {}
+        for tag in tags:
+            k = tag.k
+            if k in NODE_TAG_KEYS:
+                got[k] = tag.v
+        public_transport = got.get('public_transport')
+        highway = got.get('highway')
+        railway = got.get('railway')
+        subway = got.get('subway')
+        network = got.get('network')
+
+        # Count transport-related nodes
+        if public_transport is not None:
+            self._public_transport_buf.append(public_transport)
+            if public_transport == 'stop_position':
+                st.transit_stops += 1
+
+        if highway == 'bus_stop':
+            st.bus_stops += 1
+
+        if railway == 'station':
+            if subway == 'yes' or (network is not None and 'subway' in network.lower()):
+                st.subway_stations += 1
+
+    def way(self, w):
+        cdef _Stats st = self._stats
+        st.num_ways += 1
+        st.current_element += 1
+        if st.current_element % 10000 == 0:
+            self._update_progress()
+
+        tags = w.tags
+        if not tags:
+            return
+
+        got = {}
+        for tag in tags:
+            k = tag.k
+            if k in WAY_TAG_KEYS:
+                got[k] = tag.v
+        if not got:
+            return
+
+        if 'highway' in got:
+            self._highway_buf.append(got['highway'])
+        if 'railway' in got:
+            self._railway_buf.append(got['railway'])
+
+    def relation(self, r):
+        cdef _Stats st = self._stats
+        st.num_relations += 1
+        st.current_element += 1
+        if st.current_element % 10000 == 0:
+            self._update_progress()
+
+        tags = r.tags
+        if not tags:
+            return
+
+        got = {}
+        for tag in tags:
+            k = tag.k
+            if k in RELATION_TAG_KEYS:
+                got[k] = tag.v
+
+        if got.get('type') == 'route':
+            route = got.get('route')
+            if route is not None:
+                self._route_buf.append(route)
+
+    def _publish_stats(self):
+        """Copy the C counters and bounds onto the handler under the OSMStatsHandler names."""
+        cdef _Stats st = self._stats
+        self.num_nodes = st.num_nodes
+        self.num_ways = st.num_ways
+        self.num_relations = st.num_relations
+        self.transit_stops = st.transit_stops
+        self.subway_stations = st.subway_stations
+        self.bus_stops = st.bus_stops
+        self.current_element = st.current_element
+        self.min_lat = st.min_lat
+        self.max_lat = st.max_lat
+        self.min_lon = st.min_lon
+        self.max_lon = st.max_lon
+
+    def _flush_tags(self):
+        """Count the buffered tag values into their Counters."""
+        for counter, buf in ((self.public_transport, self._public_transport_buf),
+                             (self.highway_types, self._highway_buf),
+                             (self.railway_types, self._railway_buf),
+                             (self.transit_routes, self._route_buf)):
+            if buf:
+                counter.update(buf)
+                buf.clear()
+
+    def flush(self):
+        """Process any buffered data. Call once after the file has been applied."""
+        self._flush_tags()
+        self._publish_stats()
+
+    def _update_progress(self):
+        """Update the progress bar and count buffered tag values. Called every 10000 elements."""
+        cdef _Stats st = self._stats
+        self._flush_tags()
+        if self.progress is not None:
+            self.progress.update(10000)
+            # Rebuilding the description is far costlier than advancing the bar
+            if st.current_element % 1000000 == 0:
+                self.progress.set_description("Nodes: %d | Ways: %d | Relations: %d"
+                                              % (st.num_nodes, st.num_ways, st.num_relations))
+
+    def set_progress_bar(self, total_estimate):
+        """Initialize the progress bar with estimated total elements."""
+        self.total_elements = total_estimate
+        self.progress = tqdm(total=total_estimate, unit='elements', mininterval=0.5)
+        self.progress.set_description("Processing OSM data")
+
+    def close_progress(self):
+        """Account for elements since the last bar update and close the progress bar."""
+        cdef _Stats st = self._stats
+        if self.progress is not None:
+            self.progress.update(st.current_element % 10000)
+            self.progress.close()
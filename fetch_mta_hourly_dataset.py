@@ -1,13 +1,181 @@
+"""Download the MTA Subway Hourly Ridership dataset from the data.ny.gov SODA API.
+
+Set the SODA_APP_TOKEN environment variable to a Socrata app token to send requests
+as an authenticated application, which raises the API's throttling limits.
+"""
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+import io
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import time
 import os
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from pathlib import Path
 from tqdm import tqdm
 
-def download_mta_ridership_data(debug=True, total_rows=110696365, request_timeout=60):
+# Columns kept from each SODA record, with the types Arrow's CSV reader parses them into.
+# The georeference point duplicates latitude/longitude and is not stored.
+MTA_SCHEMA = pa.schema([
+    ("transit_timestamp", pa.timestamp("ms")),
+    ("transit_mode", pa.dictionary(pa.int32(), pa.string())),
+    ("station_complex_id", pa.dictionary(pa.int32(), pa.string())),
+    ("station_complex", pa.dictionary(pa.int32(), pa.string())),
+    ("borough", pa.dictionary(pa.int32(), pa.string())),
+    ("payment_method", pa.dictionary(pa.int32(), pa.string())),
+    ("fare_class_category", pa.dictionary(pa.int32(), pa.string())),
+    ("ridership", pa.int32()),
+    ("transfers", pa.int32()),
+    ("latitude", pa.float64()),
+    ("longitude", pa.float64()),
+])
+
+# Parse straight into MTA_SCHEMA so the reader never has to infer types
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(column_types=MTA_SCHEMA, include_columns=MTA_SCHEMA.names)
+
+# Writer settings shared by the chunk files and the combined file
+PARQUET_OPTIONS = {"compression": "zstd", "compression_level": 3}
+
+# Sent to the writer thread in place of a Table to finish a chunk file
+CLOSE_CHUNK = "close"
+DISCARD_CHUNK = "discard"
+
+def create_session(pool_size=16):
+    """Create a pooled HTTP session that retries throttled and failed requests with backoff."""
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    
+    # Responses are large, highly compressible text; requests decompresses them transparently
+    session.headers.update({"Accept-Encoding": "gzip"})
+    app_token = os.environ.get("SODA_APP_TOKEN")
+    if app_token:
+        session.headers.update({"X-App-Token": app_token})
+    return session
+
+def fetch_batch(session, base_url, params, request_timeout):
+    """Fetch one page of records. Returns (Table or None if empty, elapsed seconds)."""
+    # Make the API request with timeout
+    start_time = time.time()
+    response = session.get(base_url, params=params, timeout=request_timeout)
+    elapsed_time = time.time() - start_time
+    
+    # Check if the request was successful
+    if response.status_code != 200:
+        raise RuntimeError(f"API request failed with status code {response.status_code}\n"
+                           f"Response: {response.text}")
+    
+    # Decode the CSV page directly into typed Arrow columns; the C++ reader releases the
+    # GIL, so pages from other workers keep decoding in parallel
+    table = None
+    if response.content:
+        table = pacsv.read_csv(io.BytesIO(response.content), convert_options=CSV_CONVERT_OPTIONS)
+    
+    # Pages past the end of the range come back empty, or as just the header row
+    if table is None or table.num_rows == 0:
+        return None, elapsed_time
+    return table, elapsed_time
+
+def discard_chunk(writers, filename):
+    """Close and delete a chunk file that failed, ignoring any further errors from it."""
+    writer = writers.pop(filename, None)
+    if writer is not None:
+        try:
+            writer.close()
+        except Exception:
+            pass
+    try:
+        Path(filename).unlink(missing_ok=True)
+    except OSError:
+        pass
+
+def write_chunks(write_q, write_errors):
+    """Writer thread: drain (filename, table) items from write_q into Parquet files.
+    
+    A Table is appended to filename as a row group, CLOSE_CHUNK finishes the file and
+    DISCARD_CHUNK deletes it. Stops at a None item. Files that fail to write or close are
+    deleted and recorded in write_errors, and the queue keeps draining so fetchers never
+    block on it.
+    """
+    writers = {}
+    while True:
+        item = write_q.get()
+        if item is None:
+            break
+        filename, table = item
+        
+        # An error only ever fails this file; the loop must keep running until the None item
+        try:
+            if table is CLOSE_CHUNK or table is DISCARD_CHUNK:
+                # Closing writes the Parquet footer, so it can fail just like a write
+                writer = writers.pop(filename, None)
+                if writer is not None:
+                    writer.close()
+                if table is DISCARD_CHUNK:
+                    Path(filename).unlink(missing_ok=True)
+            elif filename not in write_errors:  # Skip the rest of a file that has already failed
+                writer = writers.get(filename)
+                if writer is None:
+                    writer = writers[filename] = pq.ParquetWriter(filename, MTA_SCHEMA, **PARQUET_OPTIONS)
+                writer.write_table(table)
+        except Exception as e:
+            write_errors.setdefault(filename, e)
+            discard_chunk(writers, filename)
+
+def download_day(session, base_url, day, batch_size, filename, write_q, request_timeout):
+    """Page through one day of records, queueing each page for filename as its own row group.
+    Returns (records, elapsed seconds)."""
+    # Filtering on the timestamp lets the server seek to the day instead of skipping
+    # over every earlier row, so offsets only ever page within a single day
+    next_day = day + timedelta(days=1)
+    where = (f"transit_timestamp >= '{day.isoformat()}T00:00:00' AND "
+             f"transit_timestamp < '{next_day.isoformat()}T00:00:00'")
+    
+    records_in_day = 0
+    elapsed_time = 0.0
+    offset = 0
+    try:
+        while True:
+            params = {
+                "$where": where,
+                "$limit": batch_size,
+                "$offset": offset,
+                "$order": ":id"
+            }
+            table, request_time = fetch_batch(session, base_url, params, request_timeout)
+            elapsed_time += request_time
+            if table is None:
+                break
+            
+            # Hand the page to the writer thread; blocks while the queue is full
+            write_q.put((filename, table))
+            records_in_day += table.num_rows
+            
+            # A short page is the last one for the day
+            if table.num_rows < batch_size:
+                break
+            offset += batch_size
+    except Exception:
+        # Drop a partially written day so it can be retried from scratch
+        if records_in_day > 0:
+            write_q.put((filename, DISCARD_CHUNK))
+        raise
+    
+    if records_in_day > 0:
+        write_q.put((filename, CLOSE_CHUNK))
+    return records_in_day, elapsed_time
+
+def download_mta_ridership_data(debug=True, total_rows=110696365, request_timeout=60, max_workers=12,
+                                start_date=date(2022, 2, 1), end_date=None):
     # API endpoint
-    base_url = "https://data.ny.gov/resource/wujg-7c2s.json"
+    base_url = "https://data.ny.gov/resource/wujg-7c2s.csv"
     
     # Create a directory for the data if it doesn't exist
     output_dir = "mta_ridership_data"
@@ -24,13 +192,19 @@ def download_mta_ridership_data(debug=True, total_rows=110696365, request_timeou
     chunk_counter = 0
     
     # Keep track of failed requests
-    failed_offsets = []
+    failed_days = []
     
     # Set a limit for debug mode
-    debug_limit = 3 * batch_size  # 3 pages
+    debug_limit = 3 * batch_size  # about one day of records
     
-    # Adjust total rows for debug mode
+    # Days are independent partitions of the dataset; end_date is exclusive
+    if end_date is None:
+        end_date = date.today()
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+    
+    # Adjust the download for debug mode
     if debug:
+        days = days[:1]
         estimated_total = min(debug_limit, total_rows)
     else:
         estimated_total = total_rows
@@ -39,118 +213,98 @@ def download_mta_ridership_data(debug=True, total_rows=110696365, request_timeou
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     print(f"Starting download at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Fetching {len(days)} days with {max_workers} concurrent requests")
     
     # Create progress bar for the overall process
-    progress_bar = tqdm(total=estimated_total, unit='records', desc="Overall Progress", position=0)
+    progress_bar = tqdm(total=estimated_total, unit='records', desc="Overall Progress", position=0,
+                        mininterval=1.0, smoothing=0.1)
     
-    # Loop until we've processed all records or hit debug limit
-    offset = 0
-    more_data = True
-    
-    while more_data:
-        # Construct the API URL with limit and offset
-        params = {
-            "$limit": batch_size,
-            "$offset": offset,
-            "$order": ":id"
-        }
-        
-        # Print status update
-        tqdm.write(f"Requesting records {offset} to {offset + batch_size}...")
+    # Shared session so connections are reused; the retry adapter backs off on 429s
+    session = create_session(pool_size=max(16, max_workers))
+    
+    # A single background thread serializes chunks so fetchers only wait on the network.
+    # The bounded queue caps how many decoded pages can be waiting in memory.
+    write_q = queue.Queue(maxsize=4)
+    write_errors = {}
+    writer_thread = threading.Thread(target=write_chunks, args=(write_q, write_errors), daemon=True)
+    writer_thread.start()
+    
+    # Records saved per day, in case a day's file later fails to write
+    day_records = {}
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Chunks are keyed by day (YYYYMMDD) so files sort in dataset order
+        futures = {}
+        for day in days:
+            filename = f"{output_dir}/mta_ridership_{timestamp}_chunk{day:%Y%m%d}.parquet"
+            future = executor.submit(download_day, session, base_url, day, batch_size,
+                                     filename, write_q, request_timeout)
+            futures[future] = (day, filename)
         
-        try:
-            # Make the API request with timeout
-            start_time = time.time()
-            response = requests.get(base_url, params=params, timeout=request_timeout)
-            elapsed_time = time.time() - start_time
+        for future in as_completed(futures):
+            day, filename = futures[future]
             
-            # Check if the request was successful
-            if response.status_code == 200:
-                # Parse the JSON response
-                data = response.json()
-                
-                # Check if we got any data
-                if len(data) == 0:
-                    tqdm.write("No more data available.")
-                    more_data = False
-                    break
-                
-                # Convert to DataFrame
-                df = pd.DataFrame(data)
-                
-                # Save this batch to a CSV file
-                chunk_counter += 1
-                filename = f"{output_dir}/mta_ridership_{timestamp}_chunk{chunk_counter}.csv"
-                df.to_csv(filename, index=False)
-                
-                # Update counters
-                records_in_batch = len(df)
-                total_records += records_in_batch
-                
-                # Update progress bar
-                progress_bar.update(records_in_batch)
-                
-                # Update the description with percentage
+            try:
+                records_in_day, elapsed_time = future.result()
+            except requests.Timeout:
+                tqdm.write(f"Request for {day} timed out after {request_timeout} seconds")
+                # Record the failed day for later retry
+                failed_days.append(day)
+                continue
+            except Exception as e:
+                tqdm.write(f"An error occurred for {day}: {e}")
+                # Record the failed day for later retry
+                failed_days.append(day)
+                continue
+            
+            if records_in_day == 0:
+                tqdm.write(f"No data available for {day}.")
+                continue
+            
+            # Update counters
+            chunk_counter += 1
+            total_records += records_in_day
+            day_records[filename] = (day, records_in_day)
+            
+            # Update progress bar
+            progress_bar.update(records_in_day)
+            
+            # Update the description with percentage every 10 chunks
+            if chunk_counter % 10 == 0:
                 progress_percent = min(100, round(total_records / estimated_total * 100, 1))
                 progress_bar.set_description(f"Overall Progress ({progress_percent}%)")
-                
-                tqdm.write(f"Saved {records_in_batch} records to {filename}")
-                tqdm.write(f"Request took {elapsed_time:.2f} seconds")
-                
-                # Update offset for next batch
-                offset += batch_size
-                
-                # Check if we've reached the debug limit
-                if debug and total_records >= debug_limit:
-                    tqdm.write(f"Debug mode: Stopping after {total_records} records")
-                    more_data = False
-                    break
-                
-                # Check if we got fewer records than requested (last batch)
-                if records_in_batch < batch_size:
-                    tqdm.write("Reached last batch of data.")
-                    more_data = False
-                    break
-                
-                # Small delay to avoid overloading the API
-                time.sleep(1)
-                
-            else:
-                tqdm.write(f"Error: API request failed with status code {response.status_code}")
-                tqdm.write(f"Response: {response.text}")
-                # Record the failed offset for later retry
-                failed_offsets.append(offset)
-                # Continue with the next batch instead of exiting
-                offset += batch_size
-                
-        except requests.Timeout:
-            tqdm.write(f"Request timed out after {request_timeout} seconds")
-            # Record the failed offset for later retry
-            failed_offsets.append(offset)
-            # Continue with the next batch instead of exiting
-            offset += batch_size
-                
-        except Exception as e:
-            tqdm.write(f"An error occurred: {e}")
-            # Record the failed offset for later retry
-            failed_offsets.append(offset)
-            # Continue with the next batch instead of exiting
-            offset += batch_size
+            
+            tqdm.write(f"Queued {records_in_day} records for {filename}")
+            tqdm.write(f"Requests took {elapsed_time:.2f} seconds")
+    
+    session.close()
+    
+    # Let the writer finish the queued chunks
+    write_q.put(None)
+    writer_thread.join()
+    for filename, error in write_errors.items():
+        tqdm.write(f"Failed to write {filename}: {error}")
+        if filename in day_records:
+            day, records_in_day = day_records[filename]
+            chunk_counter -= 1
+            total_records -= records_in_day
+            failed_days.append(day)
+    failed_days.sort()
     
     # Close the progress bar
     progress_bar.close()
     
     # Report on failed requests
-    if failed_offsets:
-        print(f"\n{len(failed_offsets)} requests failed:")
-        for failed_offset in failed_offsets:
-            print(f"  - Offset {failed_offset} to {failed_offset + batch_size}")
+    if failed_days:
+        print(f"\n{len(failed_days)} days failed:")
+        for failed_day in failed_days:
+            print(f"  - {failed_day}")
         
-        # Save failed offsets to a file for potential retry later
-        with open(f"{output_dir}/failed_offsets_{timestamp}.txt", "w") as f:
-            for offset in failed_offsets:
-                f.write(f"{offset}\n")
-        print(f"Failed offsets saved to {output_dir}/failed_offsets_{timestamp}.txt")
+        # Save failed days to a file for potential retry later
+        with open(f"{output_dir}/failed_days_{timestamp}.txt", "w") as f:
+            for day in failed_days:
+                f.write(f"{day.isoformat()}\n")
+        print(f"Failed days saved to {output_dir}/failed_days_{timestamp}.txt")
     
     # If we have multiple chunks, combine them into a single file
     if chunk_counter > 0:
@@ -159,44 +313,42 @@ def download_mta_ridership_data(debug=True, total_rows=110696365, request_timeou
         if not debug and chunk_counter > 1:
             print(f"Combining {chunk_counter} chunks into a single file...")
             
+            # Chunks that were actually written, in dataset order, leaving out any that
+            # failed to write but could not be deleted
+            chunk_paths = Path(output_dir).glob(f"mta_ridership_{timestamp}_chunk*.parquet")
+            chunk_files = sorted((path for path in chunk_paths if str(path) not in write_errors),
+                                 key=lambda path: int(path.stem.rsplit("chunk", 1)[1]))
+            
             # Create a progress bar for the combining process
-            combine_progress = tqdm(total=chunk_counter, unit='chunks', 
+            combine_progress = tqdm(total=len(chunk_files), unit='chunks', 
                                     desc="Combining Files")
             
-            # Combine all chunks into a single DataFrame
-            combined_df = pd.DataFrame()
-            for i in range(1, chunk_counter + 1):
-                chunk_file = f"{output_dir}/mta_ridership_{timestamp}_chunk{i}.csv"
-                if os.path.exists(chunk_file):  # Check if file exists
-                    chunk_df = pd.read_csv(chunk_file)
-                    combined_df = pd.concat([combined_df, chunk_df], ignore_index=True)
-                combine_progress.update(1)
+            # Append each chunk to the combined file as its own row group, so only one
+            # chunk is held in memory at a time and nothing is re-copied
+            combined_file = f"{output_dir}/mta_ridership_{timestamp}_complete.parquet"
+            with pq.ParquetWriter(combined_file, MTA_SCHEMA, **PARQUET_OPTIONS) as writer:
+                for chunk_file in chunk_files:
+                    writer.write_table(pq.read_table(chunk_file, schema=MTA_SCHEMA))
+                    combine_progress.update(1)
             
             combine_progress.close()
             
-            # Save the combined data
-            print("Saving combined file...")
-            combined_file = f"{output_dir}/mta_ridership_{timestamp}_complete.csv"
-            combined_df.to_csv(combined_file, index=False)
-            
             print(f"Combined file saved to {combined_file}")
             
             # Optionally remove the individual chunk files
             if not debug:
                 print("Removing individual chunk files...")
-                delete_progress = tqdm(total=chunk_counter, unit='files', desc="Deleting Chunks")
+                delete_progress = tqdm(total=len(chunk_files), unit='files', desc="Deleting Chunks")
                 
-                for i in range(1, chunk_counter + 1):
-                    chunk_file = f"{output_dir}/mta_ridership_{timestamp}_chunk{i}.csv"
-                    if os.path.exists(chunk_file):  # Check if file exists
-                        os.remove(chunk_file)
+                for chunk_file in chunk_files:
+                    chunk_file.unlink(missing_ok=True)
                     delete_progress.update(1)
                 
                 delete_progress.close()
         
         print(f"Finished at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        if failed_offsets:
-            print(f"Note: {len(failed_offsets)} requests failed. Some data may be missing.")
+        if failed_days:
+            print(f"Note: {len(failed_days)} days failed. Some data may be missing.")
 
 if __name__ == "__main__":
     # Set debug to False to download the entire dataset
@@ -208,9 +360,15 @@ if __name__ == "__main__":
     # Maximum time to wait for a request (in seconds)
     timeout = 60  # 1 minute
     
+    # Number of requests kept in flight at once
+    workers = 12
+    
     print("MTA Subway Hourly Ridership Data Downloader")
     print(f"Debug mode: {'ON' if debug_mode else 'OFF'}")
     print(f"Total records in dataset: {total_rows:,}")
     print(f"Request timeout: {timeout} seconds")
+    print(f"Concurrent requests: {workers}")
+    print(f"App token: {'SET' if os.environ.get('SODA_APP_TOKEN') else 'NOT SET'}")
     
-    download_mta_ridership_data(debug=debug_mode, total_rows=total_rows, request_timeout=timeout)
\ No newline at end of file
+    download_mta_ridership_data(debug=debug_mode, total_rows=total_rows, request_timeout=timeout,
+                                max_workers=workers)
\ No newline at end of file
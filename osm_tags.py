@@ -0,0 +1,6 @@
+"""OSM tag keys read by the analyze_osm.py handlers, shared by the Python and Cython versions."""
+
+# Tag keys each callback reads; everything else is skipped with one set lookup per tag
+NODE_TAG_KEYS = frozenset({'public_transport', 'highway', 'railway', 'subway', 'network'})
+WAY_TAG_KEYS = frozenset({'highway', 'railway'})
+RELATION_TAG_KEYS = frozenset({'type', 'route'})
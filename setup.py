@@ -0,0 +1,8 @@
+from setuptools import setup
+from Cython.Build import cythonize
+
+# Builds the optional compiled OSM handler: python setup.py build_ext --inplace
+setup(
+    name="analyze_osm_core",
+    ext_modules=cythonize("analyze_osm_core.pyx", compiler_directives={"language_level": 3}),
+)